@@ -10,6 +10,8 @@ name: inventory
 short_description: opinionated inventory
 description:
   - Flat inventory.
+extends_documentation_fragment:
+  - inventory_cache
 options:
     plugin:
         description: Name of the plugin.
@@ -75,12 +77,15 @@ options:
 """
 
 import copy
+import functools
+import os
 from pathlib import Path
 
 import jinja2
 
 from ansible.plugins.inventory import (
     BaseInventoryPlugin,
+    Cacheable,
     expand_hostname_range,
     detect_range,
 )
@@ -91,24 +96,65 @@ from ansible.plugins.filter.core import FilterModule
 from ansible.template import is_possibly_template
 from ansible.module_utils.common.text.converters import to_text
 from ansible import constants
+from ansible.release import __version__ as ansible_version
 
 display = Display()
 data_loader = DataLoader()
 
+YAML_SUFFIXES = (".yml", ".yaml")
+ANSIBLE_FILTERS = FilterModule().filters()
 
-def get_root_path(path: Path, root_dir: str) -> Path:
+# new keys can be written to group and host vars directly only while
+# set_variable is a plain dict assignment, which holds before ansible-core 2.19
+ANSIBLE_CORE_VERSION = tuple(int(item) for item in ansible_version.split(".")[:2])
+BULK_SET_VARIABLES = ANSIBLE_CORE_VERSION < (2, 19)
+
+
+def get_root_path(path: str, root_dir: str) -> Path:
     """
     Traverses up the path until root_dir is found.
     """
-    while str(path) != path.root:
-        if path.name == root_dir:
-            return path
-        path = path.parent
+    current = os.fspath(path)
+    while current and current != os.sep:
+        if os.path.basename(current) == root_dir:
+            return Path(current)
+        current = os.path.dirname(current)
     raise AnsibleParserError(f"Failed to find root_dir: {root_dir}, path: {path}")
 
 
-def get_contents(path: Path) -> dict:
-    return data_loader.load_from_file(str(path)) or {}
+# parsed yaml files by absolute path, cleared at the start of every parse
+_contents = {}
+
+
+def _load(path: str):
+    # data_loader's own file cache is never cleared, _contents dedups loads
+    # within a parse and rebuilds must see edited files
+    if path not in _contents:
+        _contents[path] = data_loader.load_from_file(path, cache="none", unsafe=True)
+    return _contents[path]
+
+
+def get_contents(path) -> dict:
+    """
+    Loads yaml file, parsed results are memoized per path for the duration of
+    a single parse, callers get a copy which is safe to mutate. Paths are made
+    absolute so the same file always maps to the same cache entry.
+    """
+    path = os.fspath(path)
+    if not os.path.isabs(path):
+        path = os.path.abspath(path)
+    return copy.deepcopy(_load(path)) or {}
+
+
+def list_files(path: Path) -> set:
+    """
+    Returns names of files at path using a single directory scan.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
 
 
 def parse_path(path: Path, include=None) -> dict:
@@ -119,16 +165,23 @@ def parse_path(path: Path, include=None) -> dict:
     if include is None:
         include = []
 
-    display.vvv(to_text(f"pbn_op_inventory: path: {str(path)}"))
-    for item in path.glob("*"):
-        if item.suffix not in [".yml", ".yaml"] or item.stem.startswith("_"):
-            display.vvv(to_text(f"pbn_op_inventory: skip: {item}"))
-            continue
-        if include and item.stem not in include:
-            display.vvv(to_text(f"pbn_op_inventory: excluded: {item}"))
-            continue
-        display.vvv(to_text(f"pbn_op_inventory: read: {item}"))
-        yield item.stem, get_contents(item)
+    if display.verbosity > 2:
+        display.vvv(to_text(f"pbn_op_inventory: path: {str(path)}"))
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.endswith(YAML_SUFFIXES) or name.startswith("_"):
+                if display.verbosity > 2:
+                    display.vvv(to_text(f"pbn_op_inventory: skip: {entry.path}"))
+                continue
+            stem = name.rsplit(".", 1)[0]
+            if include and stem not in include:
+                if display.verbosity > 2:
+                    display.vvv(to_text(f"pbn_op_inventory: excluded: {entry.path}"))
+                continue
+            if display.verbosity > 2:
+                display.vvv(to_text(f"pbn_op_inventory: read: {entry.path}"))
+            yield stem, get_contents(entry.path)
 
 
 def get_inventory(
@@ -137,56 +190,111 @@ def get_inventory(
     """
     Searches for var_files starting from path and stops at root_dir.
     """
-    var_files_copy = copy.copy(var_files)
-    var_filepaths = []
-    while path.name != root_dir and str(path) != path.root:
-        for idx, f in enumerate(var_files_copy):
-            variable_filepath = Path(path / f)
-            if variable_filepath.is_file():
-                var_filepaths.append(variable_filepath)
-                var_files_copy.pop(idx)
-        path = path.parent
+    optional = [] if raise_on_missing else ["vars"]
+    return get_inventory_multi(path, {"vars": var_files}, root_dir, optional)["vars"]
+
 
-    if var_files_copy and raise_on_missing:
-        raise AnsibleParserError(f"failed to find: {var_files}, aborting")
+def get_inventory_multi(
+    path: Path, file_groups: dict, root_dir: str, optional=None
+) -> dict:
+    """
+    Same as get_inventory for several named groups of var_files with a single
+    walk from path up to root_dir, returns merged vars per group name. Groups
+    listed in optional do not raise when files are missing. The walk stops
+    once every file of every group is found.
+    """
+    if optional is None:
+        optional = []
+
+    remaining = {name: set(var_files) for name, var_files in file_groups.items()}
+    var_filepaths = {}
+    while remaining and path.name != root_dir and str(path) != path.root:
+        files = list_files(path)
+        for name in list(remaining):
+            found = remaining[name] & files
+            for f in found:
+                var_filepaths.setdefault(f, path / f)
+            remaining[name] -= found
+            if not remaining[name]:
+                del remaining[name]
+        path = path.parent
 
     res = {}
-    for var_filename in var_files:
-        display.vvv(to_text(f"pbn_op_inventory: inventory: {str(path / var_filename)}"))
-        for variable_filepath in var_filepaths:
-            if variable_filepath.name == var_filename:
-                contents = get_contents(variable_filepath)
-                res.update(contents)
+    for name, var_files in file_groups.items():
+        if name not in optional and name in remaining:
+            raise AnsibleParserError(f"failed to find: {var_files}, aborting")
+        res[name] = {}
+        for var_filename in var_files:
+            variable_filepath = var_filepaths.get(var_filename)
+            if variable_filepath is None:
+                continue
+            if display.verbosity > 2:
+                display.vvv(
+                    to_text(f"pbn_op_inventory: inventory: {variable_filepath}")
+                )
+            res[name].update(get_contents(variable_filepath))
     return res
 
 
+def validate_playbook(role_filename: str, contents: list, identifier_prefix) -> tuple:
+    """
+    Determines role name and playbook vars from parsed playbook contents, raises
+    if role name can't be determined or doesn't match the playbook filename.
+    """
+    role_key = f"{identifier_prefix}_role"
+    role_name, role_vars = None, None
+    for item in contents:
+        if "hosts" in item:
+            role_name = item.get("hosts")
+        if "vars" in item:
+            role_name = item["vars"].get(role_key)
+        if role_name is None:
+            continue
+        role_vars = item.get("vars", {}) or {}
+    if role_name is None:
+        raise AnsibleParserError(f"Failed to determine role name from {role_filename}.")
+    if role_filename != role_name:
+        raise AnsibleParserError(
+            f"Playbook name role var mismatch, playbook: {role_filename} "
+            f"role var: {role_name}."
+        )
+    # if we got role from hosts, role might not be defined via vars
+    role_vars[role_key] = role_name
+    return role_name, role_vars
+
+
+def parse_playbooks(path: Path, identifier_prefix, include=None):
+    """
+    Parses playbooks, users $identifier_prefix_role as a role identifier,
+    yields role name and playbook vars.
+    """
+    for role_filename, contents in parse_path(path, include):
+        yield validate_playbook(role_filename, contents, identifier_prefix)
+
+
 def get_playbook(path: Path, identifier_prefix, include=None) -> dict:
     """
     Parses playbooks, users $identifier_prefix_role as a role identifier.
     """
-    res = {}
-    for role_filename, contents in parse_path(path, include):
-        role_name, role_vars = None, None
-        for item in contents:
-            if "hosts" in item:
-                role_name = item.get("hosts")
-            if "vars" in item:
-                role_name = item["vars"].get(f"{identifier_prefix}_role")
-            if role_name is None:
-                continue
-            role_vars = item.get("vars", {}) or {}
-        if role_name is None:
-            raise AnsibleParserError(
-                f"Failed to determine role name from {role_filename}."
-            )
-        if role_filename != role_name:
-            raise AnsibleParserError(
-                f"Playbook name role var mismatch, playbook: {role_filename} "
-                f"role var: {role_name}."
-            )
-        res[role_name] = role_vars
-        # if we got role from hosts, role might not be defined via vars
-        res[role_name][f"{identifier_prefix}_role"] = role_name
+    return dict(parse_playbooks(path, identifier_prefix, include))
+
+
+def find_role_defaults(paths: list[str], role_name: str, role_vars: dict) -> dict:
+    """
+    Parses $path/$role/defaults/main.yml, or $path/$base_role/defaults/main.yml
+    if base_role is defined in role_vars, last path found wins. Returns None if
+    defaults are not found in any of the paths.
+    """
+    res = None
+    defaults_role = role_vars.get("base_role", role_name)
+    for path in paths:
+        defaults = os.path.join(path, defaults_role, "defaults", "main.yml")
+        try:
+            if display.verbosity > 2:
+                display.vvv(to_text(f"pbn_op_inventory: defaults: {defaults}"))
+            res = get_contents(defaults)
+        except AnsibleFileNotFound:
+            pass
     return res
 
 
@@ -196,20 +304,33 @@ def get_role_defaults(paths: list[str], playbook_vars: dict) -> dict:
     playbook_vars parses roles/$base_role/defaults/main.yml
     """
     res = {}
+    paths = [str(path) for path in paths]
     for role_name, role_vars in playbook_vars.items():
-        for path in paths:
-            path = Path(path)
-            defaults = path / role_name / "defaults" / "main.yml"
-            if "base_role" in role_vars:
-                defaults = path / role_vars["base_role"] / "defaults" / "main.yml"
-            try:
-                display.vvv(to_text(f"pbn_op_inventory: defaults: {str(path / defaults)}"))
-                res[role_name] = get_contents(defaults)
-            except AnsibleFileNotFound:
-                pass
+        defaults = find_role_defaults(paths, role_name, role_vars)
+        if defaults is not None:
+            res[role_name] = defaults
     return res
 
 
+def get_playbook_and_defaults(
+    playbook_path: Path, roles_path: list[str], identifier_prefix, include=None
+) -> tuple[dict, dict]:
+    """
+    Same as get_playbook followed by get_role_defaults, defaults are read as
+    soon as each playbook is parsed.
+    """
+    playbook_vars, role_defaults = {}, {}
+    roles_path = [str(path) for path in roles_path]
+    for role_name, role_vars in parse_playbooks(
+        playbook_path, identifier_prefix, include
+    ):
+        playbook_vars[role_name] = role_vars
+        defaults = find_role_defaults(roles_path, role_name, role_vars)
+        if defaults is not None:
+            role_defaults[role_name] = defaults
+    return playbook_vars, role_defaults
+
+
 def role_inventory_override(role_vars: dict, identifier_prefix: str) -> dict:
     """
     Overrides inventory variables with role_default inventory overrides.
@@ -218,7 +339,7 @@ def role_inventory_override(role_vars: dict, identifier_prefix: str) -> dict:
     if not inventory_override:
         return {}
     common = f"{identifier_prefix}_common"
-    res = inventory_override.get(common, {})
+    res = dict(inventory_override.get(common, {}))
     for k, v in inventory_override.items():
         if k not in role_vars:
             continue
@@ -230,20 +351,28 @@ def role_inventory_override(role_vars: dict, identifier_prefix: str) -> dict:
     return res
 
 
+@functools.lru_cache(maxsize=1024)
+def _compile(jinja_env: jinja2.Environment, source: str) -> jinja2.Template:
+    return jinja_env.from_string(source)
+
+
 def template_vars(jinja_env: jinja2, role_vars: dict) -> dict:
     """
     Templates all knows variables.
     """
-    to_template = [
-        k for k, v in role_vars.items() if is_possibly_template(v, jinja_env)
-    ]
+    to_template, no_template = [], {}
+    for k, v in role_vars.items():
+        # only strings can be templates
+        if isinstance(v, str) and is_possibly_template(v, jinja_env):
+            to_template.append(k)
+        else:
+            no_template[k] = v
     if not to_template:
         return role_vars
 
-    no_template = {k: v for k, v in role_vars.items() if k not in to_template}
     for k in to_template:
         try:
-            role_vars[k] = jinja_env.from_string(role_vars[k]).render(**no_template)
+            role_vars[k] = _compile(jinja_env, role_vars[k]).render(**no_template)
         except (
             jinja2.exceptions.UndefinedError,
             jinja2.exceptions.TemplateAssertionError,
@@ -255,10 +384,36 @@ def template_vars(jinja_env: jinja2, role_vars: dict) -> dict:
     return role_vars
 
 
-def construct_hosts(role_vars: dict, jinja_env: jinja2.Environment) -> dict:
+TEMPLATE_MARKERS = (
+    jinja2.defaults.BLOCK_START_STRING,
+    jinja2.defaults.VARIABLE_START_STRING,
+    jinja2.defaults.COMMENT_START_STRING,
+)
+
+
+def has_delimiters(item) -> bool:
+    """
+    Checks if item is a string containing default jinja2 delimiters.
+    """
+    return isinstance(item, str) and any(marker in item for marker in TEMPLATE_MARKERS)
+
+
+def has_templates(role_vars: dict) -> bool:
+    """
+    Checks if any variable or hostname contains default jinja2 delimiters
+    without constructing jinja2 environment.
+    """
+    hosts = role_vars.get("hosts")
+    candidates = list(role_vars.values())
+    if isinstance(hosts, dict):
+        candidates.extend(hosts)
+    return any(has_delimiters(item) for item in candidates)
+
+
+def construct_hosts(role_vars: dict, jinja_env: jinja2.Environment = None) -> dict:
     """
     Templates any host vars if found and construct hosts from ansible
-    ranges of hosts format.
+    ranges of hosts format, templating is skipped if jinja_env is None.
     """
     hosts = role_vars.get("hosts") or {}
     if not hosts:
@@ -267,11 +422,20 @@ def construct_hosts(role_vars: dict, jinja_env: jinja2.Environment) -> dict:
         raise ValueError(f"failed to parse hosts key: {hosts}")
 
     res = {}
-    templated_vars = template_vars(jinja_env, role_vars)
+    templated_vars = role_vars
+    templated_hosts = set()
+    if jinja_env is not None:
+        templated_vars = template_vars(jinja_env, role_vars)
+        # cheap delimiter scan first, full check runs at most once per host
+        templated_hosts = {
+            host
+            for host in hosts
+            if has_delimiters(host) and is_possibly_template(host, jinja_env)
+        }
     for host, host_vars in hosts.items():
         hostname = host
-        if is_possibly_template(host, jinja_env):
-            hostname = jinja_env.from_string(host).render(**templated_vars)
+        if host in templated_hosts:
+            hostname = _compile(jinja_env, host).render(**templated_vars)
         ranged_hostnames = [hostname]
         if detect_range(hostname):
             try:
@@ -285,35 +449,78 @@ def construct_hosts(role_vars: dict, jinja_env: jinja2.Environment) -> dict:
     return res
 
 
-def get_vars(path: Path, directories: list) -> dict:
+def get_var_file(path: str, directory: str, value: str):
     """
-    Looks for var files in ansible-root/vars/$identifier_prefix_$dir_name/$var_value_defined
-    in inventory.
+    Looks for ansible-root/vars/$directory/$value.yml or .yaml, returns None
+    if not found. Only string values naming a file directly in directory are
+    looked up.
+    """
+    if not isinstance(value, str) or value in ("", ".", ".."):
+        return None
+    if os.path.basename(value) != value:
+        return None
+    for suffix in YAML_SUFFIXES:
+        var_file = os.path.join(path, directory, f"{value}{suffix}")
+        if os.path.isfile(var_file):
+            if display.verbosity > 2:
+                display.vvv(to_text(f"pbn_op_inventory: vars: {var_file}"))
+            return get_contents(var_file)
+    return None
+
+
+def get_fingerprint(paths) -> dict:
+    """
+    Returns modification time of every path, None if path does not exist.
     """
-    if not path.is_dir():
-        return {}
-
     res = {}
-    for subdirectory in path.iterdir():
-        display.vvv(to_text(f"pbn_op_inventory: get_vars: {str(subdirectory)}"))
-        if not subdirectory.is_dir():
-            continue
-        if subdirectory.stem not in directories:
-            continue
-        for item in subdirectory.iterdir():
-            if not item.is_file():
-                continue
-            if item.suffix not in [".yml", ".yaml"]:
-                continue
-            display.vvv(to_text(f"pbn_op_inventory: vars: {str(subdirectory / item)}"))
-            contents = get_contents(item)
-            res.setdefault(subdirectory.stem, {}).update({item.stem: contents})
+    for path in paths:
+        try:
+            res[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            res[path] = None
     return res
 
 
-class InventoryModule(BaseInventoryPlugin):
+def set_variables(inventory, entity: str, variables: dict):
+    """
+    Sets variables on inventory group or host with a single dict update, keys
+    which are already set and ansible_group_priority go through set_variable
+    to keep ansible merge semantics. Every key goes through set_variable if
+    bulk updates are not supported by ansible-core in use.
+    """
+    if not BULK_SET_VARIABLES:
+        for k, v in variables.items():
+            inventory.set_variable(entity, k, v)
+        return
+
+    inv_object = inventory.groups.get(entity) or inventory.hosts.get(entity)
+    if inv_object is None:
+        raise AnsibleError(f"Could not identify group or host named {entity}")
+
+    new_vars = {}
+    for k, v in variables.items():
+        if k in inv_object.vars or k == "ansible_group_priority":
+            inventory.set_variable(entity, k, v)
+        else:
+            new_vars[k] = v
+    inv_object.vars.update(new_vars)
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
     NAME = "op.inventory"
 
+    _jinja_env = None
+
+    @property
+    def jinja_env(self) -> jinja2.Environment:
+        """
+        Jinja2 environment with ansible filters, built on first use.
+        """
+        if self._jinja_env is None:
+            self._jinja_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+            self._jinja_env.filters.update(ANSIBLE_FILTERS)
+        return self._jinja_env
+
     def verify_file(self, path):
         """
         Validates if inventory source can be used by this plugin.
@@ -326,77 +533,175 @@ class InventoryModule(BaseInventoryPlugin):
 
     def parse(self, inventory, loader, path, cache=True):
         super(InventoryModule, self).parse(inventory, loader, path, cache)
+        _contents.clear()
+        _compile.cache_clear()
         self._read_config_data(path)
-        jinja_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
-        for k, v in FilterModule().filters().items():
-            jinja_env.filters.update({k: v})
 
+        cache_key = self.get_cache_key(path)
+        user_cache_setting = self.get_option("cache")
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        options = self._get_build_options()
+        results = None
+        if attempt_to_read_cache:
+            try:
+                results = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
+            else:
+                fingerprint = results.get("fingerprint", {})
+                if (
+                    results.get("options") != options
+                    or get_fingerprint(fingerprint) != fingerprint
+                ):
+                    if display.verbosity > 2:
+                        display.vvv(to_text(f"pbn_op_inventory: cache: stale {path}"))
+                    results = None
+                    cache_needs_update = True
+
+        if results is None:
+            results = self._build(path, user_cache_setting)
+            if user_cache_setting:
+                results["options"] = options
+        if cache_needs_update:
+            self._cache[cache_key] = results
+
+        self._populate(results)
+
+    def _get_build_options(self) -> dict:
+        """
+        Returns every option _build depends on, cached results are only valid
+        for the same options.
+        """
+        return {
+            "root_dir": self.get_option("root_dir"),
+            "identifier_prefix": self.get_option("identifier_prefix"),
+            "inventory_var_files": list(self.get_option("inventory_var_files")),
+            "var_dirs": list(self.get_option("var_dirs")),
+            "append_dns_domain": self.get_option("append_dns_domain"),
+            "roles_path": [str(item) for item in constants.DEFAULT_ROLES_PATH],
+        }
+
+    def _build(self, path: str, fingerprint: bool) -> dict:
+        """
+        Builds group vars and hosts for every role found next to inventory
+        source path, if fingerprint is set, records modification time of every
+        file and directory that was used so cached results can be validated.
+        """
         # ansible sets `path` as absolute path to `_inventory_yml`
         inventory_path = Path(path).parent
         root_dir = self.get_option("root_dir")
         identifier_prefix = self.get_option("identifier_prefix")
         append_dns_domain = self.get_option("append_dns_domain")
+        excluded_vars = {"hosts", f"{identifier_prefix}_inventory_override"}
+        dns_domain_key = f"{identifier_prefix}_dns_domain"
+        dns_domain_not_set = f"{identifier_prefix}_dns_domain_not_set"
 
-        root_path = get_root_path(inventory_path, root_dir)
+        root_path = get_root_path(str(inventory_path), root_dir)
 
-        common_vars = get_inventory(
+        inventory_files = get_inventory_multi(
             inventory_path,
-            ["_common.yaml", "_common.yml"],
+            {
+                "common": ["_common.yaml", "_common.yml"],
+                "inventory": self.get_option("inventory_var_files"),
+            },
             root_path.stem,
-            raise_on_missing=False,
-        )
-        inventory_vars = get_inventory(
-            inventory_path, self.get_option("inventory_var_files"), root_path.stem
+            optional=["common"],
         )
+        common_vars = inventory_files["common"]
+        inventory_vars = inventory_files["inventory"]
         group_vars = dict(parse_path(inventory_path))
         roles = list(group_vars.keys())
-        playbook_vars = get_playbook(root_path / "playbooks", identifier_prefix, roles)
-        role_defaults = get_role_defaults(constants.DEFAULT_ROLES_PATH, playbook_vars)
-        var_dirs = get_vars(root_path / "vars", self.get_option("var_dirs"))
-
+        playbook_vars, role_defaults = get_playbook_and_defaults(
+            root_path / "playbooks",
+            constants.DEFAULT_ROLES_PATH,
+            identifier_prefix,
+            roles,
+        )
+        vars_path = str(root_path / "vars")
+        var_dirs = self.get_option("var_dirs")
+        # var files by (var_dir, value), shared between roles, role vars are
+        # merged shallowly so shared contents are never modified
+        var_files = {}
+
+        # lists keep role and host order when cache plugins sort keys
+        res = {"roles": []}
         for role in roles:
-            display.vvv(to_text(f"pbn_op_inventory: role: {role}"))
-            self.inventory.add_group(role)
-            role_vars = role_defaults.get(role, {})
-            role_vars |= common_vars
-            role_group_inventory_vars = {
-                **role_vars,
-                **group_vars.get(role, {}),
-                **inventory_vars,
-            }
-            for identifier_var, _vars in var_dirs.items():
-                if identifier_var not in role_group_inventory_vars.keys():
+            if display.verbosity > 2:
+                display.vvv(to_text(f"pbn_op_inventory: role: {role}"))
+            role_group_vars = group_vars.get(role, {})
+            role_vars = role_defaults.get(role, {}) | common_vars
+            # var_dirs identifiers are looked up before var files are merged
+            role_group_inventory_vars = role_vars | role_group_vars | inventory_vars
+            for identifier_var in var_dirs:
+                if identifier_var not in role_group_inventory_vars:
+                    continue
+                value = role_group_inventory_vars[identifier_var]
+                if not isinstance(value, str):
                     continue
-                identifier_var_value = role_group_inventory_vars[identifier_var]
-                if identifier_var_value not in _vars:
+                if (identifier_var, value) not in var_files:
+                    var_files[identifier_var, value] = get_var_file(
+                        vars_path, identifier_var, value
+                    )
+                _vars = var_files[identifier_var, value]
+                if _vars is None:
                     continue
-                role_vars |= _vars[identifier_var_value]
+                # later var_dirs take precedence over earlier ones
+                role_vars |= _vars
 
             role_vars |= inventory_vars
             role_vars |= role_inventory_override(role_vars, identifier_prefix)
-            role_vars |= group_vars.get(role, {})
+            role_vars |= role_group_vars
             role_vars |= playbook_vars.get(role, {})
-            for k, v in role_vars.items():
-                if k in ["hosts", f"{identifier_prefix}_inventory_override"]:
-                    continue
-                self.inventory.set_variable(role, k, v)
+            role_res = {
+                "name": role,
+                "vars": {k: v for k, v in role_vars.items() if k not in excluded_vars},
+                "hosts": [],
+            }
+            res["roles"].append(role_res)
 
+            # template_vars updates role_vars in place, group vars above are
+            # kept untemplated and dns_domain below is read from templated vars
+            jinja_env = self.jinja_env if has_templates(role_vars) else None
             try:
                 hosts = construct_hosts(role_vars, jinja_env)
-                display.vvv(to_text(f"pbn_op_inventory: hosts: {hosts}"))
+                if display.verbosity > 2:
+                    display.vvv(to_text(f"pbn_op_inventory: hosts: {hosts}"))
             except ValueError as e:
                 raise AnsibleParserError(f"role: {role}, {e}")
 
-            dns_domain = role_vars.get(
-                f"{identifier_prefix}_dns_domain",
-                f"{identifier_prefix}_dns_domain_not_set",
-            )
+            dns_domain = role_vars.get(dns_domain_key, dns_domain_not_set)
             for host, host_vars in hosts.items():
                 hostname = host
-                if append_dns_domain and len(hostname.split(".")) == 1:
+                if append_dns_domain and "." not in hostname:
                     hostname = f"{hostname}.{dns_domain}"
-                self.inventory.add_host(hostname, group=role)
-                for k, v in host_vars.items():
-                    if not v:
-                        continue
-                    self.inventory.set_variable(hostname, k, v)
+                role_res["hosts"].append(
+                    (hostname, {k: v for k, v in host_vars.items() if v})
+                )
+
+        if fingerprint:
+            paths = [path, *_contents]
+            path = inventory_path
+            while path != root_path.parent:
+                paths.append(str(path))
+                path = path.parent
+            paths.append(str(root_path / "playbooks"))
+            paths.extend(os.path.join(vars_path, var_dir) for var_dir in var_dirs)
+            for role_name, role_vars in playbook_vars.items():
+                defaults_role = role_vars.get("base_role", role_name)
+                for roles_path in constants.DEFAULT_ROLES_PATH:
+                    paths.append(os.path.join(roles_path, defaults_role, "defaults"))
+            res["fingerprint"] = get_fingerprint(paths)
+        return res
+
+    def _populate(self, results: dict):
+        """
+        Adds groups and hosts built by _build to inventory.
+        """
+        for role in results["roles"]:
+            self.inventory.add_group(role["name"])
+            set_variables(self.inventory, role["name"], role["vars"])
+            for hostname, host_vars in role["hosts"]:
+                self.inventory.add_host(hostname, group=role["name"])
+                set_variables(self.inventory, hostname, host_vars)
@@ -1,34 +1,45 @@
-from __future__ import absolute_import, division, print_function
-
-__metaclass__ = type
-
+import json
+import os
 import unittest
 import tempfile
 import shutil
+import sys
 
 from pathlib import Path
+from types import MappingProxyType
+from unittest import mock
 
 import yaml
 import jinja2
 
 from ansible.errors import AnsibleParserError
-from ansible.plugins.filter.core import FilterModule
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 try:
     from ansible_collections.pbn.op.plugins.inventory.inventory import (
         get_root_path,
         parse_path,
         get_playbook,
+        validate_playbook,
         get_inventory,
+        get_inventory_multi,
         get_role_defaults,
+        get_playbook_and_defaults,
         construct_hosts,
+        has_templates,
         template_vars,
         role_inventory_override,
-        get_vars,
+        get_var_file,
+        set_variables,
+        get_fingerprint,
+        InventoryModule,
+        _compile,
+        ANSIBLE_FILTERS,
     )
 except ImportError:
-    import sys
-
     sys.path.append("plugins/inventory")
     sys.path.append("tests")
     # noinspection PyUnresolvedReferences
@@ -36,155 +47,350 @@ except ImportError:
         get_root_path,
         parse_path,
         get_playbook,
+        validate_playbook,
         get_inventory,
+        get_inventory_multi,
         get_role_defaults,
+        get_playbook_and_defaults,
         construct_hosts,
+        has_templates,
         template_vars,
         role_inventory_override,
-        get_vars,
+        get_var_file,
+        set_variables,
+        get_fingerprint,
+        InventoryModule,
+        _compile,
+        ANSIBLE_FILTERS,
     )
 
 
+def dump_fixture(obj) -> bytes:
+    """
+    Serializes yaml fixture as json, fixtures are plain scalars, maps and lists
+    so json is valid yaml and the C encoder is considerably faster than
+    yaml.dump.
+    """
+    return json.dumps(obj).encode()
+
+
+def freeze(obj):
+    """
+    Wraps obj and every nested dict in a read-only MappingProxyType.
+    """
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    return obj
+
+
+def write_files(path, files: dict):
+    """
+    Writes {filename: bytes} fixtures into path, directory is opened once and
+    files are created relative to it.
+    """
+    dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for name, payload in files.items():
+            fd = os.open(
+                name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644, dir_fd=dir_fd
+            )
+            try:
+                os.write(fd, payload)
+            finally:
+                os.close(fd)
+    finally:
+        os.close(dir_fd)
+
+
+INVENTORY_VAR_FILES = ["_common.yml", "_site.yml", "_env.yml"]
+INVENTORY_LAYOUT = {
+    "inventory/_common.yml": {"common_var": "initial"},
+    "inventory/site/_site.yml": {
+        "test_site": "site",
+        "common_var": "override",
+        "site_var": "initial",
+    },
+    "inventory/site/env/_env.yml": {
+        "test_env": "env",
+        "site_var": "override",
+        "env_var": "initial",
+    },
+}
+
+# wrapper playbook, __TEST_ROLE__ is replaced with role name when written
+PLAYBOOK_TEMPLATE = dump_fixture(
+    [
+        {
+            "import_playbook": "_provision.yml",
+            "vars": {"test_product": "test-product", "test_role": "__TEST_ROLE__"},
+        }
+    ]
+)
+
+
+# expected results are shared between runs, frozen including nested dicts so
+# tests can't mutate them
+_EXPECTED_INVENTORY_VARS = freeze(
+    {
+        "common_var": "override",
+        "env_var": "initial",
+        "site_var": "override",
+        "test_env": "env",
+        "test_site": "site",
+    }
+)
+_EXPECTED_TEMPLATED_VARS = freeze(
+    {
+        "ternary_filter_test": "yes",
+        "test_dns_domain": "site.env.test",
+        "test_env": "env",
+        "test_site": "site",
+    }
+)
+_EXPECTED_CONSTRUCT_HOSTS = freeze(
+    {
+        "test-host01": {"host01_var": "host01_value"},
+        "test-host02": {"host_ranged_var": "host_ranged_value"},
+        "test-host03": {"host_ranged_var": "host_ranged_value"},
+        "test-host04.site": {},
+    }
+)
+_EXPECTED_CONSTRUCT_HOSTS_WITHOUT_JINJA_ENV = freeze(
+    {
+        "test-host01": {"host01_var": "host01_value"},
+        "test-host02": {},
+        "test-host03": {},
+    }
+)
+_EXPECTED_ROLE_INVENTORY_OVERRIDE = freeze(
+    {
+        "test_site": "site-name",
+        "test_env": "env-name",
+        "test_site_env": "site-name_env-name",
+        "default_variable_one": "overriden_in_role_defaults_common",
+        "default_variable_two": "overriden_in_role_defaults_env",
+        "default_variable_three": "overriden_in_role_defaults_site_env",
+    }
+)
+
+
+class JsonCache(dict):
+    """
+    In memory inventory cache which stores json, same as jsonfile cache plugin.
+    """
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, json.dumps(value))
+
+    def __getitem__(self, key):
+        return json.loads(super().__getitem__(key))
+
+
+JINJA_ENV = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+JINJA_ENV.filters.update(ANSIBLE_FILTERS)
+
+
 class TestOpInventory(unittest.TestCase):
     test_dir = None
-    jinja_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
-    for k, v in FilterModule().filters().items():
-        jinja_env.filters.update({k: v})
+    jinja_env = JINJA_ENV
+
+    @classmethod
+    def setUpClass(cls):
+        cls._root = Path(tempfile.mkdtemp())
+        cls._root_fd = os.open(cls._root, os.O_RDONLY | os.O_DIRECTORY)
+
+        # inventory tree shared by get_inventory tests, tests which modify it
+        # must restore it
+        cls._inventory_root = cls._root / "_inventory"
+        cls._inventory_path = cls._inventory_root / "inventory" / "site" / "env"
+        os.makedirs(cls._inventory_path)
+        for filename, contents in INVENTORY_LAYOUT.items():
+            directory, name = os.path.split(filename)
+            write_files(cls._inventory_root / directory, {name: dump_fixture(contents)})
+
+    @classmethod
+    def tearDownClass(cls):
+        os.close(cls._root_fd)
+        shutil.rmtree(cls._root)
 
     def setUp(self):
-        self.test_dir = Path(tempfile.mkdtemp())
-
-    def tearDown(self):
-        shutil.rmtree(self.test_dir)
+        os.mkdir(self._testMethodName, dir_fd=self._root_fd)
+        self.test_dir = self._root / self._testMethodName
+        self.test_dir_s = str(self.test_dir)
+
+    def _mk(self, rel: str) -> str:
+        """
+        Creates rel, which must not exist yet, and any missing parents in the
+        test directory relative to the parent directory fd, only parents are
+        opened. Returns the path.
+        """
+        *parents, leaf = rel.split("/")
+        fd = os.open(
+            self._testMethodName, os.O_RDONLY | os.O_DIRECTORY, dir_fd=self._root_fd
+        )
+        try:
+            for comp in parents:
+                try:
+                    os.mkdir(comp, dir_fd=fd)
+                except FileExistsError:
+                    pass
+                parent_fd = fd
+                fd = os.open(comp, os.O_RDONLY | os.O_DIRECTORY, dir_fd=parent_fd)
+                os.close(parent_fd)
+            os.mkdir(leaf, dir_fd=fd)
+        finally:
+            os.close(fd)
+        return os.path.join(self.test_dir_s, rel)
+
+    def test_dump_fixture_round_trip(self):
+        for contents in [*INVENTORY_LAYOUT.values(), {"flag": True, "empty": None}]:
+            self.assertEqual(yaml.load(dump_fixture(contents), Loader=Loader), contents)
+
+    def test_expected_results_frozen(self):
+        with self.assertRaises(TypeError):
+            _EXPECTED_CONSTRUCT_HOSTS["test-host01"]["host01_var"] = "mutated"
+        self.assertEqual(
+            _EXPECTED_CONSTRUCT_HOSTS["test-host01"], {"host01_var": "host01_value"}
+        )
 
     def test_get_root_path_exists(self):
-        p = self.test_dir / "foo" / "bar" / "baz"
-        p.mkdir(parents=True)
-        self.assertEqual(get_root_path(p, "foo"), self.test_dir / "foo")
+        p = self._mk("foo/bar/baz")
+        self.assertEqual(
+            get_root_path(p, "foo"), Path(os.path.join(self.test_dir_s, "foo"))
+        )
 
     def test_ansible_root_path_raises(self):
-        p = self.test_dir / "foo" / "bar" / "baz"
-        p.mkdir(parents=True)
+        p = self._mk("foo/bar/baz")
         with self.assertRaises(AnsibleParserError):
             get_root_path(p, "quux")
 
     def test_path_parse_include(self):
-        p = self.test_dir / "test"
-        p.mkdir(parents=True)
-        for item in ["foo.yml", "bar.yaml", "quux", "quux.yml"]:
-            p.joinpath(item).write_text(yaml.dump({"filename": item}))
+        p = self._mk("test")
+        write_files(
+            p,
+            {
+                item: f"filename: {item}\n".encode("ascii")
+                for item in ["foo.yml", "bar.yaml", "quux", "quux.yml"]
+            },
+        )
         self.assertEqual(
             dict(parse_path(p, ["foo", "bar"])),
             {"foo": {"filename": "foo.yml"}, "bar": {"filename": "bar.yaml"}},
         )
 
     def test_get_inventory_merge_order(self):
-        inventory_path = self.test_dir / "inventory" / "site" / "env"
-        inventory_path.mkdir(parents=True)
+        inventory_vars = get_inventory(
+            self._inventory_path, INVENTORY_VAR_FILES, self._inventory_root.name
+        )
+        self.assertEqual(inventory_vars, _EXPECTED_INVENTORY_VARS)
 
-        _common_p = self.test_dir / "inventory" / "_common.yml"
-        _site_p = self.test_dir / "inventory" / "site" / "_site.yml"
-        _env_p = self.test_dir / "inventory" / "site" / "env" / "_env.yml"
+    def test_get_inventory_raises_on_missing(self):
+        _site_p = self._inventory_root / "inventory" / "site" / "_site.yml"
+        self.addCleanup(_site_p.write_bytes, _site_p.read_bytes())
+        _site_p.unlink()
 
-        _common_p.write_text(
-            yaml.dump(
-                {
-                    "common_var": "initial",
-                }
-            )
-        )
-        _site_p.write_text(
-            yaml.dump(
-                {"test_site": "site", "common_var": "override", "site_var": "initial"}
+        with self.assertRaises(AnsibleParserError):
+            get_inventory(
+                self._inventory_path, INVENTORY_VAR_FILES, self._inventory_root.name
             )
+
+    def test_get_inventory_multi(self):
+        inventory_path = self._mk("inventory/sites/site")
+
+        # root_dir itself is not searched
+        write_files(self.test_dir_s, {"_env.yml": b"env_var: root\n"})
+        write_files(
+            os.path.join(self.test_dir_s, "inventory"),
+            {"_common.yaml": b"upper_var: upper\n"},
         )
-        _env_p.write_text(
-            yaml.dump({"test_env": "env", "site_var": "override", "env_var": "initial"})
-        )
-        inventory_vars = get_inventory(
-            inventory_path, ["_common.yml", "_site.yml", "_env.yml"], self.test_dir
+        write_files(
+            os.path.join(self.test_dir_s, "inventory", "sites"),
+            {
+                "_common.yml": dump_fixture(
+                    {"common_var": "initial", "site_var": "common"}
+                )
+            },
         )
+        write_files(inventory_path, {"_site.yml": b"site_var: initial\n"})
+
+        root_dir = self.test_dir.name
+        file_groups = {
+            "common": ["_common.yaml", "_common.yml"],
+            "inventory": ["_site.yml"],
+        }
+        # _common.* files are merged from every level, not only the nearest
         self.assertEqual(
-            inventory_vars,
+            get_inventory_multi(
+                Path(inventory_path), file_groups, root_dir, optional=["common"]
+            ),
             {
-                "common_var": "override",
-                "env_var": "initial",
-                "site_var": "override",
-                "test_env": "env",
-                "test_site": "site",
+                "common": {
+                    "upper_var": "upper",
+                    "common_var": "initial",
+                    "site_var": "common",
+                },
+                "inventory": {"site_var": "initial"},
             },
         )
+        file_groups["common"] = ["_common.yaml", "_common.yml", "_missing.yml"]
+        with self.assertRaises(AnsibleParserError):
+            get_inventory_multi(Path(inventory_path), file_groups, root_dir)
+        with self.assertRaises(AnsibleParserError):
+            get_inventory_multi(
+                Path(inventory_path), {"inventory": ["_env.yml"]}, root_dir
+            )
 
-    def test_get_inventory_raises_on_missing(self):
-        inventory_path = self.test_dir / "inventory" / "site" / "env"
-        inventory_path.mkdir(parents=True)
-
-        _common_p = self.test_dir / "inventory" / "_common.yml"
-        _env_p = self.test_dir / "inventory" / "site" / "env" / "_env.yml"
+    def test_get_inventory_same_directory(self):
+        inventory_path = self._mk("inventory/site")
 
-        _common_p.write_text(
-            yaml.dump(
-                {
-                    "common_var": "initial",
-                }
-            )
-        )
-        _env_p.write_text(
-            yaml.dump({"test_site": "site", "test_env": "env", "env_var": "initial"})
+        write_files(
+            inventory_path,
+            {
+                "_site.yml": b"test_site: site\n",
+                "_env.yml": b"test_env: env\n",
+            },
         )
 
-        with self.assertRaises(AnsibleParserError):
-            get_inventory(
-                inventory_path, ["_common.yml", "_site.yml", "_env.yml"], self.test_dir
-            )
+        inventory_vars = get_inventory(
+            Path(inventory_path), ["_site.yml", "_env.yml"], self.test_dir.name
+        )
+        self.assertEqual(inventory_vars, {"test_site": "site", "test_env": "env"})
 
     def test_role_defaults_base_role(self):
-        base_role_p = self.test_dir / "roles" / "base_role" / "defaults"
-        base_role_p.mkdir(parents=True)
-        base_role_p.joinpath("main.yml").write_text(
-            yaml.dump({"base_role_var": "initial"})
-        )
+        base_role_p = self._mk("roles/base_role/defaults")
+        write_files(base_role_p, {"main.yml": b"base_role_var: initial\n"})
 
         playbook_vars = {"test": {"test_role": "test", "base_role": "base_role"}}
 
         role_defaults = get_role_defaults(
-            [str(self.test_dir / "roles")], playbook_vars
+            [os.path.join(self.test_dir_s, "roles")], playbook_vars
         )
         self.assertEqual(role_defaults, {"test": {"base_role_var": "initial"}})
 
     def test_get_playbook(self):
-        p = self.test_dir / "test"
-        p.mkdir(parents=True)
-        p.joinpath("playbook_one.yml").write_text(
-            yaml.dump(
-                [
-                    {
-                        "import_playbook": "_provision.yml",
-                        "vars": {
-                            "test_product": "test-product",
-                            "test_role": "playbook_one",
-                            "base_role": "test_role",
-                        },
-                    }
-                ]
-            )
-        )
-        p.joinpath("playbook_two.yml").write_text(
-            yaml.dump(
-                [
-                    {
-                        "import_playbook": "_provision.yml",
-                        "vars": {
-                            "test_product": "test-product",
-                            "test_role": "playbook_two",
-                        },
-                    }
-                ]
-            )
+        p = self._mk("test")
+        playbook_one = [
+            {
+                "import_playbook": "_provision.yml",
+                "vars": {
+                    "test_product": "test-product",
+                    "test_role": "playbook_one",
+                    "base_role": "test_role",
+                },
+            }
+        ]
+        write_files(
+            p,
+            {
+                "playbook_one.yml": dump_fixture(playbook_one),
+                "playbook_two.yml": PLAYBOOK_TEMPLATE.replace(
+                    b"__TEST_ROLE__", b"playbook_two"
+                ),
+            },
         )
 
         self.assertEqual(
-            get_playbook(p, "test", ["playbook_one"]),
+            get_playbook(Path(p), "test", ["playbook_one"]),
             {
                 "playbook_one": {
                     "base_role": "test_role",
@@ -194,25 +400,50 @@ class TestOpInventory(unittest.TestCase):
             },
         )
 
-    def test_get_playbook_role_filename_mismatch_raises(self):
-        p = self.test_dir / "test"
-        p.mkdir(parents=True)
-        p.joinpath("playbook_one.yml").write_text(
-            yaml.dump(
-                [
-                    {
-                        "import_playbook": "_provision.yml",
-                        "vars": {
-                            "test_product": "test-product",
-                            "test_role": "playbook_role_var_name_mismatch",
-                        },
-                    }
-                ]
-            )
+    def test_get_playbook_and_defaults(self):
+        base_role_p = self._mk("roles/base_role/defaults")
+        write_files(base_role_p, {"main.yml": b"base_role_var: initial\n"})
+        p = self._mk("test")
+        playbook_one = [
+            {
+                "import_playbook": "_provision.yml",
+                "vars": {"test_role": "playbook_one", "base_role": "base_role"},
+            }
+        ]
+        write_files(
+            p,
+            {
+                "playbook_one.yml": dump_fixture(playbook_one),
+                "playbook_two.yml": dump_fixture([{"hosts": "playbook_two"}]),
+            },
+        )
+
+        self.assertEqual(
+            get_playbook_and_defaults(
+                p, [os.path.join(self.test_dir_s, "roles")], "test"
+            ),
+            (
+                {
+                    "playbook_one": {
+                        "base_role": "base_role",
+                        "test_role": "playbook_one",
+                    },
+                    "playbook_two": {"test_role": "playbook_two"},
+                },
+                {"playbook_one": {"base_role_var": "initial"}},
+            ),
         )
 
+    def test_validate_playbook_role_filename_mismatch_raises(self):
+        contents = [
+            {
+                "import_playbook": "_provision.yml",
+                "vars": {"test_role": "playbook_role_var_name_mismatch"},
+            }
+        ]
+
         with self.assertRaises(AnsibleParserError):
-            get_playbook(p, "test")
+            validate_playbook("playbook_one", contents, "test")
 
     def test_templated_vars(self):
         role_vars = {
@@ -224,14 +455,18 @@ class TestOpInventory(unittest.TestCase):
         templated_vars = template_vars(self.jinja_env, role_vars)
         self.assertEqual(
             templated_vars,
-            {
-                "ternary_filter_test": "yes",
-                "test_dns_domain": "site.env.test",
-                "test_env": "env",
-                "test_site": "site",
-            },
+            _EXPECTED_TEMPLATED_VARS,
         )
 
+    def test_templated_vars_compiled_once(self):
+        role_vars = {"test_site": "site", "test_dns_domain": "{{ test_site }}.test"}
+        _compile.cache_clear()
+        template_vars(self.jinja_env, dict(role_vars))
+        template_vars(self.jinja_env, dict(role_vars))
+        info = _compile.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 1)
+
     def test_construct_hosts(self):
         role_vars = {
             "hosts": {
@@ -245,12 +480,47 @@ class TestOpInventory(unittest.TestCase):
 
         self.assertEqual(
             construct_hosts(role_vars, self.jinja_env),
-            {
+            _EXPECTED_CONSTRUCT_HOSTS,
+        )
+
+    def test_construct_hosts_checks_templates_once(self):
+        role_vars = {
+            "hosts": {
+                "test-host01": {},
+                "test-host02": {},
+                "test-host03.{{ test_site }}": {},
+            },
+            "test_site": 5,
+        }
+
+        plugin_module = sys.modules[construct_hosts.__module__]
+        with mock.patch.object(
+            plugin_module,
+            "is_possibly_template",
+            wraps=plugin_module.is_possibly_template,
+        ) as is_possibly_template:
+            hosts = construct_hosts(role_vars, self.jinja_env)
+        self.assertEqual(list(hosts), ["test-host01", "test-host02", "test-host03.5"])
+        is_possibly_template.assert_called_once_with(
+            "test-host03.{{ test_site }}", self.jinja_env
+        )
+
+    def test_has_templates(self):
+        self.assertFalse(has_templates({"test_site": "site", "hosts": {"host01": {}}}))
+        self.assertTrue(has_templates({"test_dns_domain": "{{ test_site }}.test"}))
+        self.assertTrue(has_templates({"hosts": {"host01.{{ test_site }}": {}}}))
+
+    def test_construct_hosts_without_jinja_env(self):
+        role_vars = {
+            "hosts": {
                 "test-host01": {"host01_var": "host01_value"},
-                "test-host02": {"host_ranged_var": "host_ranged_value"},
-                "test-host03": {"host_ranged_var": "host_ranged_value"},
-                "test-host04.site": {},
+                "test-host[02:03]": {},
             },
+        }
+
+        self.assertEqual(
+            construct_hosts(role_vars),
+            _EXPECTED_CONSTRUCT_HOSTS_WITHOUT_JINJA_ENV,
         )
 
     def test_role_inventory_override(self):
@@ -282,61 +552,208 @@ class TestOpInventory(unittest.TestCase):
             "default_variable_two": "defaults",
             "default_variable_three": "defaults",
         }
+        common_override = role_vars["test_inventory_override"]["test_common"]
         role_vars |= role_inventory_override(role_vars, "test")
+        self.assertEqual(
+            common_override,
+            {"default_variable_one": "overriden_in_role_defaults_common"},
+        )
         del role_vars["test_inventory_override"]
         self.assertEqual(
             role_vars,
-            {
-                "test_site": "site-name",
-                "test_env": "env-name",
-                "test_site_env": "site-name_env-name",
-                "default_variable_one": "overriden_in_role_defaults_common",
-                "default_variable_two": "overriden_in_role_defaults_env",
-                "default_variable_three": "overriden_in_role_defaults_site_env",
-            },
+            _EXPECTED_ROLE_INVENTORY_OVERRIDE,
         )
 
-    def test_get_vars(self):
-        test_provider_dir = self.test_dir / "vars" / "test_provider"
-        test_env_dir = self.test_dir / "vars" / "test_env"
+    def test_get_var_file(self):
+        test_provider_dir = self._mk("vars/test_provider")
+        write_files(test_provider_dir, {"proxmox.yaml": b"variable_one: proxmox\n"})
 
-        for item in [test_provider_dir, test_env_dir]:
-            item.mkdir(parents=True)
+        p = os.path.join(self.test_dir_s, "vars")
+        self.assertEqual(
+            get_var_file(p, "test_provider", "proxmox"), {"variable_one": "proxmox"}
+        )
+        self.assertIsNone(get_var_file(p, "test_provider", "aws"))
+        self.assertIsNone(get_var_file(p, "test_env", "prod"))
 
-        test_provider_dir.joinpath("aws.yml").write_text(
-            yaml.dump(
-                {
-                    "variable_one": "aws",
-                }
-            )
+        write_files(
+            test_provider_dir, {"5.yml": b"variable_one: five\n", "None.yml": b"{}\n"}
         )
-        test_provider_dir.joinpath("proxmox.yaml").write_text(
-            yaml.dump({"variable_one": "proxmox", "variable_two": "proxmox"})
+        write_files(p, {"escape.yml": b"variable_one: escape\n"})
+        for value in [5, None, "../escape", "", ".."]:
+            self.assertIsNone(get_var_file(p, "test_provider", value))
+
+    def test_set_variables(self):
+        inventory = InventoryData()
+        inventory.add_group("test_role")
+        inventory.set_variable("test_role", "existing_var", "initial")
+
+        set_variables(
+            inventory,
+            "test_role",
+            {
+                "existing_var": "override",
+                "new_var": "initial",
+                "ansible_group_priority": 10,
+            },
         )
-        test_env_dir.joinpath("dev.yml").write_text(
-            yaml.dump({"variable_two": "dev", "variable_three": "dev"})
+        group = inventory.groups["test_role"]
+        self.assertEqual(group.vars, {"existing_var": "override", "new_var": "initial"})
+        self.assertEqual(group.priority, 10)
+
+    def test_set_variables_without_bulk_updates(self):
+        inventory = InventoryData()
+        inventory.add_host("test-host01")
+
+        plugin_module = sys.modules[set_variables.__module__]
+        with mock.patch.object(plugin_module, "BULK_SET_VARIABLES", False):
+            with mock.patch.object(
+                inventory, "set_variable", wraps=inventory.set_variable
+            ) as set_variable:
+                set_variables(inventory, "test-host01", {"new_var": "initial"})
+        set_variable.assert_called_once_with("test-host01", "new_var", "initial")
+        self.assertEqual(inventory.hosts["test-host01"].vars["new_var"], "initial")
+
+    def test_get_fingerprint(self):
+        write_files(self.test_dir_s, {"test.yml": b"test_var: initial\n"})
+        p = os.path.join(self.test_dir_s, "test.yml")
+        missing = os.path.join(self.test_dir_s, "missing.yml")
+
+        fingerprint = get_fingerprint([p, missing])
+        self.assertEqual(fingerprint[p], os.stat(p).st_mtime_ns)
+        self.assertIsNone(fingerprint[missing])
+
+    def _write_parse_tree(self) -> str:
+        """
+        Writes ansible root with a single web role, returns inventory path.
+        """
+        root = self._mk("inventory")
+        inventory_path = self._mk("inventory/sites/site/env")
+        self._mk("inventory/playbooks")
+        write_files(
+            inventory_path,
+            {
+                "_inventory.yml": b"plugin: pbn.op.inventory\n",
+                "_site.yml": b"test_site: site\n",
+                "_env.yml": b"test_dns_domain: '{{ test_site }}.test'\n",
+                "web.yml": b"hosts:\n  web01:\n",
+            },
         )
-        test_env_dir.joinpath("prod.yml").write_text(
-            yaml.dump({"variable_one": "prod", "variable_three": "prod"})
+        write_files(os.path.join(root, "playbooks"), {"web.yml": b"- hosts: web\n"})
+        return inventory_path
+
+    @staticmethod
+    def _make_plugin(options: dict) -> InventoryModule:
+        """
+        Returns plugin reading options from dict instead of inventory source.
+        """
+        plugin = InventoryModule()
+        plugin._read_config_data = lambda path: None
+        plugin.get_option = options.__getitem__
+        plugin._cache = JsonCache()
+        return plugin
+
+    def test_parse_cache(self):
+        inventory_path = self._write_parse_tree()
+        source = os.path.join(inventory_path, "_inventory.yml")
+
+        options = {
+            "cache": True,
+            "root_dir": "inventory",
+            "identifier_prefix": "test",
+            "inventory_var_files": ["_site.yml", "_env.yml"],
+            "var_dirs": [],
+            "append_dns_domain": True,
+        }
+        plugin = self._make_plugin(options)
+        builds = []
+        build = plugin._build
+        plugin._build = lambda *args: builds.append(args) or build(*args)
+
+        def parse():
+            inventory = InventoryData()
+            plugin.parse(inventory, DataLoader(), source)
+            return inventory
+
+        def touch(path):
+            mtime = os.stat(path).st_mtime_ns + 10**9
+            os.utime(path, ns=(mtime, mtime))
+
+        inventory = parse()
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(list(inventory.hosts), ["web01.site.test"])
+        self.assertEqual(inventory.groups["web"].vars["test_role"], "web")
+
+        # cache hit, populated from json round trip of built results
+        cached = parse()
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(list(cached.hosts), list(inventory.hosts))
+        self.assertEqual(cached.groups["web"].vars, inventory.groups["web"].vars)
+
+        # stale when inventory source, var files or options change
+        touch(source)
+        parse()
+        self.assertEqual(len(builds), 2)
+        touch(os.path.join(inventory_path, "_env.yml"))
+        parse()
+        self.assertEqual(len(builds), 3)
+        # rebuilt results are read from disk again, not from a stale file cache
+        write_files(inventory_path, {"_site.yml": b"test_site: edited\n"})
+        touch(os.path.join(inventory_path, "_site.yml"))
+        edited = parse()
+        self.assertEqual(len(builds), 4)
+        self.assertEqual(edited.groups["web"].vars["test_site"], "edited")
+        self.assertEqual(list(edited.hosts), ["web01.edited.test"])
+        options["append_dns_domain"] = False
+        self.assertEqual(list(parse().hosts), ["web01"])
+        self.assertEqual(len(builds), 5)
+        parse()
+        self.assertEqual(len(builds), 5)
+
+    def test_parse_var_dirs(self):
+        inventory_path = self._write_parse_tree()
+        source = os.path.join(inventory_path, "_inventory.yml")
+        write_files(
+            inventory_path,
+            {
+                "_site.yml": b"test_site: site\ntest_provider: proxmox\n",
+                # test_region value has no var file, test_zone is not set
+                "_env.yml": b"test_env: prod\ntest_region: missing\n",
+            },
         )
-
-        vars_dirs = ["test_provider", "test_env"]
-        inventory_vars = {"test_provider": "proxmox", "test_env": "prod"}
-
-        p = self.test_dir / "vars"
-        from pprint import pprint
-
-        pprint(get_vars(p, vars_dirs))
-        self.assertEqual(
-            get_vars(p, vars_dirs),
+        # shared vars parent is created once, leaves without walking it again
+        vars_path = self._mk("inventory/vars")
+        for item in ["test_provider", "test_env", "test_region"]:
+            os.mkdir(os.path.join(vars_path, item))
+        test_provider_dir = os.path.join(vars_path, "test_provider")
+        test_env_dir = os.path.join(vars_path, "test_env")
+        write_files(
+            test_provider_dir,
             {
-                "test_env": {
-                    "dev": {"variable_three": "dev", "variable_two": "dev"},
-                    "prod": {"variable_one": "prod", "variable_three": "prod"},
-                },
-                "test_provider": {
-                    "aws": {"variable_one": "aws"},
-                    "proxmox": {"variable_one": "proxmox", "variable_two": "proxmox"},
-                },
+                "proxmox.yml": b"shared_var: provider\nprovider_var: yml\n",
+                "proxmox.yaml": b"provider_var: yaml\n",
             },
         )
+        write_files(test_env_dir, {"prod.yml": b"shared_var: env\n"})
+
+        options = {
+            "cache": False,
+            "root_dir": "inventory",
+            "identifier_prefix": "test",
+            "inventory_var_files": ["_site.yml", "_env.yml"],
+            "var_dirs": ["test_provider", "test_region", "test_zone", "test_env"],
+            "append_dns_domain": False,
+        }
+
+        def parse_group_vars():
+            inventory = InventoryData()
+            self._make_plugin(options).parse(inventory, DataLoader(), source)
+            return inventory.groups["web"].vars
+
+        # later var_dirs take precedence, .yml is preferred over .yaml
+        group_vars = parse_group_vars()
+        self.assertEqual(group_vars["shared_var"], "env")
+        self.assertEqual(group_vars["provider_var"], "yml")
+        self.assertEqual(group_vars["test_region"], "missing")
+
+        options["var_dirs"] = ["test_env", "test_provider"]
+        self.assertEqual(parse_group_vars()["shared_var"], "provider")